@@ -1,10 +1,23 @@
 import os
 import sys
+import asyncio
 import openai
-import json
+import httpx
+import orjson
+import msgpack
+import fastjsonschema
 import yaml
 import inspect
+import typing
+import time
 import datetime
+import functools
+import hashlib
+import collections
+import uuid
+import queue
+import threading
+import atexit
 
 # try to load the config
 if not os.path.exists("config.yaml"):
@@ -15,34 +28,158 @@ config = {}
 try:
     with open("config.yaml", 'r') as f:
         config = yaml.safe_load(f.read())
-except:
+except (OSError, yaml.YAMLError):
     print("Error while loading config. Please check it for errors!")
     exit()
 
+# when enabled, every message added to the context window gets appended to ctx.jsonl
+_DEBUG_CTX = config.get("debug_ctx_dump", False)
+
+# log lines are written to the log file by a background thread, through a single file handle
+_log_q = queue.Queue()
+_log_fh = open(config["logfile"], "a", buffering=1 << 16)
+
+def _log_writer():
+    while True:
+        line = _log_q.get()
+        try:
+            _log_fh.write(line)
+            # writes are batched while lines keep coming in, and flushed as soon as the queue runs dry
+            if _log_q.empty():
+                _log_fh.flush()
+        except OSError as e:
+            # keep the thread alive, otherwise nothing would drain the queue and exiting would hang
+            print(f"Error while writing to the log file: {e}", file=sys.stderr)
+        finally:
+            _log_q.task_done()
+
+threading.Thread(target=_log_writer, daemon=True).start()
+
+@atexit.register
+def _flush_log():
+    # make sure queued lines make it to disk before the daemon thread gets killed
+    _log_q.join()
+    _log_fh.flush()
+
+# the log timestamp only has minute resolution, so it's only formatted again once the minute changes
+_TS_CACHE = [-1, ""]
+
+def _ts():
+    minute = int(time.time() // 60)
+    if minute != _TS_CACHE[0]:
+        _TS_CACHE[:] = [minute, datetime.datetime.now().strftime("%d-%m-%Y %H:%M")]
+    return _TS_CACHE[1]
+
 def log(event: str, msg: str, truncate: bool = True):
     """log a message to both stdout and a log file"""
 
     event = event.upper()
-    current_time = datetime.datetime.strftime(datetime.datetime.now(), "%d-%m-%Y %H:%M")
+    current_time = _ts()
 
     msg_formatted = f"{current_time} | [{event}] {msg}\n"
     if truncate:
         print(f"[{event}] {msg[:100]}..")
     else:
         print(f"[{event}] {msg}..")
-    with open(config.get("logfile"), "a") as f:
-        f.write(msg_formatted)
+    _log_q.put_nowait(msg_formatted)
+
+# maps python type annotations to their JSON schema type names
+_PARAM_TYPE_MAP = {
+    str: "string",
+    int: "integer",
+    float: "number",
+    list: "array",
+    bool: "boolean",
+    dict: "object"
+}
+
+@functools.lru_cache(maxsize=None)
+def _build_tool_schema(func_name: str, func_obj) -> dict:
+    """builds the toolcall object for a function. these never change, so they're only built once"""
+
+    # dynamically load class methods from classes
+    func_params = inspect.signature(func_obj).parameters
+    func_params_translated = {}
+    # parameters without a default value have to be passed by the AI
+    func_params_required = []
+    # add method arguments (parameters) to the tool call object
+    for param_name, param in func_params.items():
+        if param.kind in (inspect.Parameter.VAR_POSITIONAL, inspect.Parameter.VAR_KEYWORD):
+            # *args and **kwargs can't be passed as named JSON arguments
+            continue
+
+        # translate the parameter's type annotation to the correct format, unannotated parameters are strings.
+        # generics like list[str] or typing.Dict[str, int] are looked up by their origin type
+        if param.annotation is inspect.Parameter.empty:
+            param_type = "string"
+        else:
+            param_type = _PARAM_TYPE_MAP.get(param.annotation) or _PARAM_TYPE_MAP.get(typing.get_origin(param.annotation))
+
+        func_params_translated[param_name] = {"description": None}
+        # annotations we can't translate (Optional, Union, Any, custom classes..) get no type, so any value is accepted
+        if param_type:
+            # a None default means the AI may pass null as well
+            func_params_translated[param_name]["type"] = [param_type, "null"] if param.default is None else param_type
+        if param.default is inspect.Parameter.empty:
+            func_params_required.append(param_name)
+
+    # if there's a docstring, make sure to pass that on to the LLM
+    docstring = ""
+    if "__doc__" in dir(func_obj):
+        docstring = func_obj.__doc__
+
+    # build toolcall object
+    return {
+        "type": "function",
+        "function": {
+            "name": func_name,
+            "description": docstring,
+            "parameters": {
+                "type": "object",
+                "properties": func_params_translated,
+                #"properties": {},
+                "required": func_params_required,
+                "additionalProperties": False,
+            },
+            "strict": True,
+        },
+    }
 
 class ConversationManager:
     """handles sending/receiving messages to/from the AI"""
 
     def __init__(self, client):
         self._client = client
-        self._ctx = []
-        self._tools = []
-        self._toolclasses = []
+        # the static prefix is built once and only ever overwritten in place,
+        # so the start of every request stays byte-identical and provider prompt caches keep hitting
+        self._static_prefix = [{"role": "system", "content": ""}]
+        # everything after the prefix is append-only, until it grows past max_messages.
+        # then the oldest messages get folded into a summary message that sits at the start of the tail
+        self._dynamic_tail = []
+        self._max_msgs = config.get("max_messages", 20)
+        self._evict_msgs = config.get("evict_messages", 10)
+        self._summary_msg = {"role": "system", "content": ""}
+        # when enabled, new context messages get appended to ctx_file as msgpack, and to ctx.jsonl when debugging.
+        # this is the index of the first message in the tail that hasn't been written yet
+        self._ctx_dump_idx = 0
+        ctx_file = config.get("ctx_file")
+        self._ctx_file = open(ctx_file, "ab") if ctx_file else None
+        self._ctx_dump_file = open("ctx.jsonl", "a") if _DEBUG_CTX else None
+        self._tools = ()
+        # maps tool names to the function that gets called for them
+        self._tool_dispatch = {}
+        # compiled validators for each tool's arguments
+        self._validators = {}
         self._last_tool_call = None
         self._last_tool_call_args = None
+        # set when the last send() ended with the AI repeating its last tool call
+        self._loop_detected = False
+        # responses to heartbeats, keyed on a hash of everything the heartbeat response depends on
+        self._heartbeat_cache = collections.OrderedDict()
+        # hash of the system prompt and tool definitions, only recomputed when one of them changes
+        self._prefix_hash = b""
+        # streamed tokens are flushed to stdout every ~30ms instead of once per token
+        self._last_flush = time.monotonic()
 
     def add_tool_class(self, toolclass, api_key: str = None):
         """
@@ -55,71 +192,35 @@ class ConversationManager:
         you can also just pass a python module to this function!
         """
 
-        self._toolclasses.append(toolclass)
-
+        new_tools = []
         for func_name in dir(toolclass):
             if func_name.startswith("_"):
                 # skip private methods and other private properties
                 continue
 
-            try:
-                func_obj = getattr(toolclass, func_name)
-            except:
+            func_obj = getattr(toolclass, func_name, None)
+            if func_obj is None or not callable(func_obj):
                 continue
 
-            if not callable(func_obj):
+            if func_name in self._tool_dispatch:
+                # the first class that has a tool with this name wins
+                log("loading", f"skipping tool {func_name}, it was already added")
                 continue
 
-            # dynamically load class methods from classes
-            func_params = inspect.signature(func_obj).parameters
-            func_params_translated = {}
-            # add method arguments (parameters) to the tool call object
-            for param_name, param in func_params.items():
-                # translate parameter type name to the correct format
-                param_split = str(param).split(":")
-                param_name = param_split[0].strip()
-                param_type = "str"
-                if len(param_split) > 1:
-                    param_type = param_split[1].split()[0].strip()
-
-                param_type_map = {
-                    "str": "string",
-                    "int": "integer",
-                    "list": "array",
-                    "bool": "boolean"
-                    # TODO: support more types
-                }
-
-                for word, replacement in param_type_map.items():
-                    if param_type == word:
-                        param_type = replacement
-
-                func_params_translated[param_name] = {"type": param_type, "description": None}
-
-            # if there's a docstring, make sure to pass that on to the LLM
-            docstring = ""
-            if "__doc__" in dir(func_obj):
-                docstring = func_obj.__doc__
-
-            # build toolcall object
-            tool = {
-                "type": "function",
-                "function": {
-                    "name": func_name,
-                    "description": docstring,
-                    "parameters": {
-                        "type": "object",
-                        "properties": func_params_translated,
-                        #"properties": {},
-                        "required": [],
-                        "additionalProperties": False,
-                    },
-                    "strict": True,
-                },
-            }
+            tool = _build_tool_schema(func_name, func_obj)
 
             log("loading", f"adding tool {func_name}")
-            self._tools.append(tool)
+            new_tools.append(tool)
+            self._tool_dispatch[func_name] = func_obj
+            self._validators[func_name] = fastjsonschema.compile(tool["function"]["parameters"])
+
+        # keep the tool definitions in a stable order and freeze them,
+        # so every request sends the exact same tool block and it stays part of the cached prefix
+        self._tools = tuple(sorted([*self._tools, *new_tools], key=lambda t: t["function"]["name"]))
+        self._update_prefix_hash()
+
+    def _update_prefix_hash(self):
+        self._prefix_hash = hashlib.blake2b(orjson.dumps([self._static_prefix, self._tools]), digest_size=16).digest()
 
     def load_system_prompt(self):
         if not os.path.exists("system_prompt.md"):
@@ -127,27 +228,79 @@ class ConversationManager:
                 f.write("")
 
         with open("system_prompt.md", "r") as f:
-            log("system", "re-inserting system prompt")
-            self.insert_context("system", f.read())
+            log("system", "loading system prompt")
+            self._static_prefix[0]["content"] = f.read()
+        self._update_prefix_hash()
 
     def insert_context(self, role: str, msg: str):
         """inserts something into the context window without sending a message"""
 
         msg_stripped = msg.strip().replace("\n", " ")
-        return self._ctx.append({"role": role, "content": str(msg)})
+        return self._dynamic_tail.append({"role": role, "content": str(msg)})
+
+    async def trim_context(self):
+        """summarize the oldest messages in the context window once it gets too long"""
+
+        # the summary message is never evicted itself, it gets rewritten instead
+        has_summary = bool(self._dynamic_tail) and self._dynamic_tail[0] is self._summary_msg
+        history = self._dynamic_tail[1:] if has_summary else self._dynamic_tail
+        if len(history) <= self._max_msgs:
+            return
+
+        # evict enough to get back under max_messages, even when a single turn added a lot of messages
+        cut = max(self._evict_msgs, len(history) - self._max_msgs)
+        # never split a tool call from its response
+        while cut < len(history) and history[cut]["role"] == "tool_response":
+            cut += 1
+
+        evicted = history[:cut]
+        log("context", f"summarizing {len(evicted)} old messages")
+
+        # tool calls don't have regular content, so flatten everything to text for the summarizer
+        evicted_text = "\n".join(f"{m['role']}: {m.get('content', m.get('arguments', ''))}" for m in evicted)
+        if self._summary_msg["content"]:
+            evicted_text = f"Summary so far: {self._summary_msg['content']}\n{evicted_text}"
+
+        response = await self._client.chat.completions.create(
+            model=config.get("summary_model", config.get("model")),
+            messages=[
+                {"role": "system", "content": "Summarize concisely:"},
+                {"role": "user", "content": evicted_text}
+            ],
+            stream=False
+        )
 
-    def send(self, role: str, msg: str, silent=False):
-        """send a message to the AI as the chosen role and stream the response"""
+        self._summary_msg["content"] = (response.choices[0].message.content or "").strip()
+        self._dynamic_tail = [self._summary_msg] + history[cut:]
+        # everything left in the tail was already dumped before trimming
+        self._ctx_dump_idx = len(self._dynamic_tail)
 
-        if not silent:
-            log("request to AI", f"{role}: {msg}")
+    def dump_context(self):
+        """append the messages added since the last dump to the context files"""
+
+        new_msgs = self._dynamic_tail[self._ctx_dump_idx:]
+        if not new_msgs:
+            return
+
+        if self._ctx_file:
+            # a stream of msgpack objects, msgpack.Unpacker reads it back one message at a time
+            for m in new_msgs:
+                msgpack.pack(m, self._ctx_file, use_bin_type=True)
+            self._ctx_file.flush()
+
+        if self._ctx_dump_file:
+            self._ctx_dump_file.write("\n".join(orjson.dumps(m).decode() for m in new_msgs) + "\n")
+            self._ctx_dump_file.flush()
+
+        self._ctx_dump_idx = len(self._dynamic_tail)
 
-        self.insert_context(role, str(msg))
+    async def _stream_response(self, messages: list, silent=False):
+        """stream a response to the given messages, returns the streamed text and a list of (id, name, arguments) tool calls"""
 
         # send the request
-        stream = self._client.chat.completions.create(
+        stream = await self._client.chat.completions.create(
             model=config.get("model"),
-            messages=self._ctx,
+            messages=messages,
             tools=self._tools,
             stream=True
         )
@@ -155,14 +308,34 @@ class ConversationManager:
         # stream the response
         chunks = []
         final_tool_calls = {}
-        for chunk in stream:
+        # streamed tool call arguments are collected per tool call index and joined once after the stream ends,
+        # instead of growing a string with every delta
+        arg_bufs = {}
+        # for tool calls repeating the last tool, how much of the last call's arguments they matched so far.
+        # an exact repeat gets cut off as soon as it's complete, so the model doesn't keep generating
+        dup_offsets = {}
+        loop_detected = False
+        out = None
+        if not silent:
+            # anything print()ed before this has to land before the raw stream bytes
+            sys.stdout.flush()
+            # write to the raw buffer when there is one, redirected or captured stdouts only take text
+            out = getattr(sys.stdout, "buffer", None)
+            encode = out is not None
+            if out is None:
+                out = sys.stdout
+        async for chunk in stream:
             streamed_token = chunk.choices[0].delta
 
             # print the latest token in the stream
             if streamed_token.content:
                 chunks.append(streamed_token.content)
                 if not silent:
-                    print(streamed_token.content, end="", flush=True)
+                    out.write(streamed_token.content.encode() if encode else streamed_token.content)
+                    now = time.monotonic()
+                    if now - self._last_flush > 0.03:
+                        out.flush()
+                        self._last_flush = now
 
             # handle tool calls, if any
             if streamed_token.tool_calls:
@@ -170,55 +343,144 @@ class ConversationManager:
                 for tool_call in streamed_token.tool_calls:
                     index = tool_call.index
 
+                    # the first delta of a tool call carries its id and name
                     if index not in final_tool_calls:
                         final_tool_calls[index] = tool_call
+                        if self._last_tool_call_args and tool_call.function.name == self._last_tool_call:
+                            dup_offsets[index] = 0
+
+                    args_delta = tool_call.function.arguments or ""
+                    arg_bufs.setdefault(index, []).append(args_delta)
+
+                    offset = dup_offsets.get(index)
+                    if offset is not None:
+                        if self._last_tool_call_args.startswith(args_delta, offset):
+                            dup_offsets[index] = offset + len(args_delta)
+                        else:
+                            dup_offsets[index] = None
+
+                        if dup_offsets[index] == len(self._last_tool_call_args):
+                            loop_detected = True
+                            break
+
+            if loop_detected:
+                # stop the generation, send() handles the duplicate like any other repeated tool call
+                log("toolcall", "AI is repeating the last tool call, closing the stream early")
+                await stream.close()
+                break
 
-                    final_tool_calls[index].function.arguments += tool_call.function.arguments
+        # and print whatever is left in the buffer
+        if out is not None:
+            out.flush()
+
+        tool_calls = [(tool_call.id, tool_call.function.name, "".join(arg_bufs[index])) for index, tool_call in final_tool_calls.items()]
+        return "".join(chunks), tool_calls
+
+    async def send(self, role: str, msg: str, silent=False, persist=True):
+        """
+        send a message to the AI as the chosen role and stream the response
+
+        if persist is False, the message is only sent as the last message of this request
+        and never stored in the context window (used for the heartbeat)
+        """
+
+        self._loop_detected = False
+
+        if not silent:
+            log("request to AI", f"{role}: {msg}")
+
+        message = {"role": role, "content": str(msg)}
+        if persist:
+            self._dynamic_tail.append(message)
+            messages = self._static_prefix + self._dynamic_tail
+        else:
+            messages = self._static_prefix + self._dynamic_tail + [message]
+
+        # the heartbeat only differs by its timestamp, so when nothing else changed an earlier response can be reused
+        cache_key = None
+        if not persist:
+            # tool call ids are unique per call, so they're left out or no key would ever repeat
+            recent = [{k: v for k, v in m.items() if k != "tool_call_id"} for m in self._dynamic_tail[-5:]]
+            cache_key = hashlib.blake2b(self._prefix_hash + orjson.dumps([recent, self._last_tool_call]), digest_size=16).digest()
+
+        cached = self._heartbeat_cache.get(cache_key) if cache_key else None
+        if cached:
+            log("cache", "reusing the response to an identical heartbeat")
+            self._heartbeat_cache.move_to_end(cache_key)
+            result, cached_tool_calls = cached
+            # replayed tool calls get fresh ids, so the context never holds the same id twice
+            tool_calls = [(f"call_{uuid.uuid4().hex}", tool_name, tool_args) for _, tool_name, tool_args in cached_tool_calls]
+        else:
+            result, tool_calls = await self._stream_response(messages, silent)
 
         # call any tool calls based on the stored tool call function
-        for index, tool_call in final_tool_calls.items():
+        tools_called = False
+        for tool_call_id, tool_name, tool_args in tool_calls:
             # does the method exist within any of the loaded classes?
-            toolclass = None
-            for class_obj in self._toolclasses:
-                if toolclass:
-                    # use the first class found that has the target method
-                    continue
+            func_callable = self._tool_dispatch.get(tool_name)
 
-                if hasattr(class_obj, tool_call.function.name):
-                    toolclass = class_obj
-
-            if toolclass:
-                if tool_call.function.name == self._last_tool_call and tool_call.function.arguments == self._last_tool_call_args:
+            if func_callable is not None:
+                if tool_name == self._last_tool_call and tool_args == self._last_tool_call_args:
                     log("toolcall", "AI tried calling the same tool again")
-                    self.send("system", json.dumps({"error": f"ALERT!! You are entering an endless loop. Stop what you are doing and choose a different action. Details: You already called this tool before! look at your list of tools and call a tool that isn't {tool_call.function.name}."}))
+                    await self.send("system", orjson.dumps({"error": f"ALERT!! You are entering an endless loop. Stop what you are doing and choose a different action. Details: You already called this tool before! look at your list of tools and call a tool that isn't {tool_name}."}).decode())
+                    self._loop_detected = True
+                    return
+                # parse and check the arguments, so a malformed tool call becomes an error the AI can correct
+                # instead of crashing the heartbeat
+                try:
+                    arg_obj = orjson.loads(tool_args or "{}")
+                    self._validators[tool_name](arg_obj)
+                except (orjson.JSONDecodeError, fastjsonschema.JsonSchemaException) as e:
+                    log("toolcall", f"AI called tool {tool_name} with invalid arguments: {e}")
+                    await self.send("system", orjson.dumps({"error": f"Invalid arguments for tool {tool_name}: {e}. Check the tool's parameters and try again."}).decode())
                     return
-                # then get the class method object
-                func_callable = getattr(toolclass, tool_call.function.name)
-                # format its arguments in a JSON format the llm will understand
-                arg_obj = json.loads(tool_call.function.arguments)
-                log("toolcall", f"calling tool {tool_call.function.name}")
-                # call the class method
-                func_response = func_callable(**arg_obj)
+                log("toolcall", f"calling tool {tool_name}")
+                # call the class method in a worker thread, so blocking tools don't stall the event loop
+                func_response = await asyncio.to_thread(func_callable, **arg_obj)
                 # and add the method's return value to the LLM's context window as a tool call response
-                self._ctx.append({"role": "tool_call", "tool_call_id": tool_call.id, "arguments": tool_call.function.arguments})
-                self._ctx.append({"role": "tool_response", "tool_call_id": tool_call.id, "content": json.dumps(str(func_response))})
+                self._dynamic_tail.append({"role": "tool_call", "tool_call_id": tool_call_id, "arguments": tool_args})
+                self._dynamic_tail.append({"role": "tool_response", "tool_call_id": tool_call_id, "content": orjson.dumps(str(func_response)).decode()})
 
-                self._last_tool_call = tool_call.function.name
-                self._last_tool_call_args = tool_call.function.arguments
+                self._last_tool_call = tool_name
+                self._last_tool_call_args = tool_args
+                tools_called = True
             else:
-                log("toolcall", f"tried to call tool {tool_call.function.name} but couldnt find it?!")
+                log("toolcall", f"tried to call tool {tool_name} but couldnt find it?!")
+
+        # only responses that actually ran a tool get cached, anything else would leave the conversation
+        # unchanged and the same heartbeat would replay the same response forever
+        if cache_key:
+            if not tools_called:
+                self._heartbeat_cache.pop(cache_key, None)
+            elif not cached:
+                self._heartbeat_cache[cache_key] = (result, tool_calls)
+                if len(self._heartbeat_cache) > 64:
+                    self._heartbeat_cache.popitem(last=False)
 
         # return the final streamed text response
-        result = "".join(chunks)
         if result:
-            self._ctx.append({"role": "assistant", "content": str(result)})
+            self._dynamic_tail.append({"role": "assistant", "content": str(result)})
             log("AI", result)
 
+        self.dump_context()
+        await self.trim_context()
+
         return result
 
-if __name__ == "__main__":
+# the heartbeat message, split around the parts that change between heartbeats
+_HB_PREFIX = "Current Time: "
+_HB_MID = " | Last tool used: "
+_HB_SUFFIX = " | What do you want to do next? You must ALWAYS call a tool. Choose a different tool than the last tool used."
+
+async def main():
     # connect to the AI endpoint
-    client = openai.OpenAI(base_url="http://localhost:5001/v1", api_key="dummy")
+    # one pooled HTTP/2 capable connection is kept alive and reused by every heartbeat
+    http = httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=4, keepalive_expiry=60.0),
+        timeout=httpx.Timeout(None, connect=2.0)
+    )
+    client = openai.AsyncOpenAI(base_url="http://localhost:5001/v1", api_key="dummy", http_client=http)
 
     convo = ConversationManager(client)
 
@@ -230,22 +492,32 @@ if __name__ == "__main__":
     convo.load_system_prompt()
 
     print("Starting up Automatic AI..")
-    system_prompt_repeat_counter = 0
+
+    # the heartbeat waits at least min_heartbeat_interval seconds, and backs off exponentially
+    # while the AI keeps repeating itself, since that usually means it has nothing to do
+    min_interval = config.get("min_heartbeat_interval", 1.0)
+    max_interval = config.get("max_heartbeat_interval", 30.0)
+    heartbeat_interval = min_interval
 
     # main loop
     while True:
         now = datetime.datetime.now().isoformat()
         try:
             # basically the heartbeat
-            convo.send("system", f"Current Time: {now} | Last tool used: {convo._last_tool_call} | What do you want to do next? You must ALWAYS call a tool. Choose a different tool than the last tool used.", silent=True)
-
-            system_prompt_repeat_counter += 1
-            if system_prompt_repeat_counter > 6:
-                # insert system prompt again.. so that it never forgets
-                convo.load_system_prompt()
-                system_prompt_repeat_counter = 0
+            # it's sent as the last message of the request but never stored, so the cached prefix stays intact
+            await convo.send("system", _HB_PREFIX + now + _HB_MID + str(convo._last_tool_call) + _HB_SUFFIX, silent=True, persist=False)
 
         except Exception as e:
             log("error", f"error while sending request to LLM: {e}. trying again.")
 
+        if convo._loop_detected:
+            heartbeat_interval = min(heartbeat_interval * 2, max_interval)
+            log("heartbeat", f"AI is looping, waiting {heartbeat_interval}s before the next heartbeat")
+        else:
+            heartbeat_interval = min_interval
+        await asyncio.sleep(heartbeat_interval)
+
+if __name__ == "__main__":
+    asyncio.run(main())
+
     print()